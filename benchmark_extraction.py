@@ -0,0 +1,125 @@
+"""
+Batch metadata extraction benchmark
+Compares thread-based and process-pool extraction throughput as the number
+of workers grows.
+
+Usage:
+    python benchmark_extraction.py URL [URL ...]
+    python benchmark_extraction.py --file urls.txt --max-workers 8
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import yt_dlp
+from downloader_core import (
+    INFO_OPTS, extract_video_info, _extract_in_worker, _init_extraction_worker,
+    _warm_up
+)
+
+# One YoutubeDL per benchmark thread, like _worker_ydl in the pool processes,
+# so both modes run with the same warm extractor caches
+_thread_state = threading.local()
+
+
+def load_urls(args):
+    """Collect URLs from the command line and the optional URL file"""
+    urls = list(args.urls)
+    if args.file:
+        with open(args.file, 'r') as f:
+            urls.extend(line.strip() for line in f if line.strip())
+    return urls * args.repeat
+
+
+def worker_counts(max_workers):
+    """Return 1, 2, 4, ... up to max_workers (always including max_workers)"""
+    counts = []
+    n = 1
+    while n < max_workers:
+        counts.append(n)
+        n *= 2
+    counts.append(max_workers)
+    return counts
+
+
+def run_batch(executor, func, urls):
+    """Extract all URLs with the given executor and return (seconds, errors)"""
+    start = time.perf_counter()
+    errors = 0
+    for future in [executor.submit(func, url) for url in urls]:
+        try:
+            future.result()
+        except Exception:
+            errors += 1
+    return time.perf_counter() - start, errors
+
+
+def _init_thread():
+    _thread_state.ydl = yt_dlp.YoutubeDL(INFO_OPTS)
+
+
+def _extract_in_thread(url):
+    return extract_video_info(url, _thread_state.ydl)
+
+
+def bench_threads(urls, workers):
+    with ThreadPoolExecutor(max_workers=workers, initializer=_init_thread) as executor:
+        # Start every thread before timing; the barrier keeps each warm-up
+        # task busy until all threads exist
+        barrier = threading.Barrier(workers)
+        for future in [executor.submit(barrier.wait) for _ in range(workers)]:
+            future.result()
+        return run_batch(executor, _extract_in_thread, urls)
+
+
+def bench_processes(urls, workers):
+    # Same start method as get_extraction_pool in the app
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_extraction_worker) as executor:
+        # Warm the pool first, the app keeps its pool alive between checks
+        for future in [executor.submit(_warm_up) for _ in range(workers)]:
+            future.result()
+        return run_batch(executor, _extract_in_worker, urls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batch video checks")
+    parser.add_argument('urls', nargs='*', help="YouTube URLs to check")
+    parser.add_argument('--file', help="File with one URL per line")
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1,
+                        help="Largest worker count to test (default: CPU count)")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="Check every URL this many times")
+    args = parser.parse_args()
+
+    urls = load_urls(args)
+    if not urls:
+        parser.error("no URLs given")
+
+    print(f"{len(urls)} checks, {os.cpu_count()} CPUs")
+    print("scaling = throughput relative to the same mode with 1 worker, "
+          "proc/thread = process throughput relative to threads")
+    print(f"{'workers':>7}{'threads/s':>11}{'scaling':>9}{'procs/s':>10}{'scaling':>9}"
+          f"{'proc/thread':>13}{'errors':>8}")
+
+    thread_base = process_base = None
+    for workers in worker_counts(args.max_workers):
+        thread_seconds, thread_errors = bench_threads(urls, workers)
+        process_seconds, process_errors = bench_processes(urls, workers)
+        thread_rate = len(urls) / thread_seconds
+        process_rate = len(urls) / process_seconds
+        if thread_base is None:
+            thread_base, process_base = thread_rate, process_rate
+        print(f"{workers:>7}{thread_rate:>11.2f}{thread_rate / thread_base:>8.2f}x"
+              f"{process_rate:>10.2f}{process_rate / process_base:>8.2f}x"
+              f"{process_rate / thread_rate:>12.2f}x{thread_errors + process_errors:>8}")
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
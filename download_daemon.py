@@ -0,0 +1,662 @@
+"""
+Download Daemon
+Runs a single download engine in the background and exposes it over a local
+HTTP/JSON API, so the desktop application and scripts share one queue, one
+FFmpeg probe and one bandwidth limit.
+
+Usage:
+    python download_daemon.py [--host 127.0.0.1] [--port 8765] [--workers 3]
+
+API:
+    GET    /health              Daemon status
+    POST   /info                {"url": ...} -> video information
+    POST   /jobs                {"url": ..., "quality": ..., "type": ...}
+                                (or a list of them) -> queued job(s);
+                                a list is only queued if every item is valid
+    GET    /jobs                All jobs
+    GET    /jobs/<id>           One job
+    DELETE /jobs/<id>           Cancel a job
+    GET    /events[?job=<id>]   Server-Sent Events stream of job updates
+
+Every request must carry "Authorization: Bearer <token>", with the token
+stored in configurations/daemon_token (created on first start, readable
+only by the current user). POST bodies must be sent as application/json,
+and downloads can only be saved inside the configured download folder.
+"""
+
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import queue
+import collections
+import secrets
+import argparse
+import threading
+import subprocess
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from downloader_core import (
+    DownloadTask, DownloadCancelled, check_ffmpeg, extract_video_info,
+    extract_video_info_in_pool, get_extraction_pool, shutdown_extraction_pool
+)
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_URL = f'http://{DEFAULT_HOST}:{DEFAULT_PORT}'
+
+CONFIG_PATH = 'configurations/configurations.json'
+TOKEN_PATH = 'configurations/daemon_token'
+
+# Job states; the last three are final
+QUEUED = 'queued'
+DOWNLOADING = 'downloading'
+COMPLETED = 'completed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINAL_STATES = (COMPLETED, FAILED, CANCELLED)
+
+# Minimum time between two progress events of the same job
+PROGRESS_INTERVAL = 0.5
+
+# Finished jobs are forgotten after this many seconds, or sooner when more
+# than MAX_FINISHED_JOBS have piled up
+FINISHED_JOB_TTL = 3600
+MAX_FINISHED_JOBS = 1000
+
+
+class Job:
+    """A queued or running download"""
+
+    def __init__(self, url, download_path, quality='best', download_type='video',
+                 format_index=None, policy=None):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.download_path = download_path
+        self.quality = quality
+        self.download_type = download_type
+        self.format_index = format_index
+        self.policy = policy
+        self.status = QUEUED
+        self.percent = 0.0
+        self.speed = ''
+        self.filename = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.task = None
+        self.last_event = 0.0
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'url': self.url,
+            'download_path': self.download_path,
+            'quality': self.quality,
+            'type': self.download_type,
+            'status': self.status,
+            'percent': self.percent,
+            'speed': self.speed,
+            'filename': self.filename,
+            'error': self.error,
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+
+class EventBus:
+    """Fans job updates out to every connected event stream"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=1000)
+        with self._lock:
+            self._subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                pass  # Slow client, it can still poll /jobs
+
+
+class DownloadEngine:
+    """Owns the job queue and the download worker threads"""
+
+    def __init__(self, download_path, workers=3, rate_limit=None,
+                 write_buffer_kb=0, preallocate_files=True, policy=None,
+                 process_pool=False):
+        self.download_path = download_path
+        self.workers = workers
+        self.write_buffer_kb = write_buffer_kb
+        self.preallocate_files = preallocate_files
+        self.policy = policy or {}
+        self.process_pool = process_pool
+        # The total limit is split between the worker threads
+        self.job_rate_limit = rate_limit // workers if rate_limit else None
+        self.ffmpeg_available = check_ffmpeg()
+        self.events = EventBus()
+        self.jobs = {}
+        self.finished_ids = collections.deque()  # In the order they finished
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.threads = []
+
+    def start(self):
+        if self.process_pool:
+            get_extraction_pool()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.worker_loop,
+                                      name=f'download-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Cancel running downloads and stop the extraction pool"""
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            if job.status not in FINAL_STATES:
+                self.cancel(job.id)
+        shutdown_extraction_pool()
+
+    def info(self, url):
+        if self.process_pool:
+            return extract_video_info_in_pool(url)
+        return extract_video_info(url)
+
+    def allowed_folders(self):
+        """Folders jobs may save into: the daemon's own and the configured one"""
+        folders = [self.download_path]
+        # Re-read so a folder chosen in the window is accepted without a restart
+        configured = load_config().get('folder_path')
+        if configured:
+            folders.append(configured)
+        return [os.path.realpath(folder) for folder in folders]
+
+    def check_download_path(self, path):
+        """Return path if it is inside an allowed folder, else raise ValueError"""
+        real_path = os.path.realpath(path)
+        for folder in self.allowed_folders():
+            try:
+                if os.path.commonpath([real_path, folder]) == folder:
+                    return real_path
+            except ValueError:
+                pass  # Different drives on Windows
+        raise ValueError(f"download_path must be inside {self.download_path}")
+
+    def create_job(self, params):
+        """Build a Job from a JSON request body, raising ValueError if invalid"""
+        if not isinstance(params, dict) or not params.get('url'):
+            raise ValueError("'url' is required")
+        quality = str(params.get('quality', 'best'))
+        if quality != 'best' and not quality.isdigit():
+            raise ValueError("'quality' must be 'best' or a height such as '720'")
+        job = Job(
+            params['url'],
+            self.check_download_path(params.get('download_path') or self.download_path),
+            quality,
+            params.get('type', 'video'),
+            params.get('format_index'),
+            params.get('policy') or self.policy
+        )
+        return job
+
+    def submit(self, params):
+        """Queue a download described by a JSON request body"""
+        return self.submit_many([params])[0]
+
+    def submit_many(self, items):
+        """Queue several downloads; none is queued if any of them is invalid"""
+        jobs = [self.create_job(params) for params in items]
+        with self.lock:
+            self.prune()
+            for job in jobs:
+                self.jobs[job.id] = job
+        for job in jobs:
+            self.queue.put(job.id)
+            self.publish(job)
+        return jobs
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            self.prune()
+            return sorted(self.jobs.values(), key=lambda job: job.created)
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status in FINAL_STATES:
+                return job
+            if job.task is not None:
+                # Running jobs are marked cancelled by their worker
+                job.task.cancel()
+                return job
+            self.finish(job, CANCELLED)
+        self.publish(job)
+        return job
+
+    def finish(self, job, status):
+        """Move a job to a final state (call with self.lock held)"""
+        job.status = status
+        job.finished = time.time()
+        job.task = None
+        job.format_index = None  # Not needed anymore, keeps memory low
+        self.finished_ids.append(job.id)
+
+    def prune(self):
+        """Forget old finished jobs (call with self.lock held)"""
+        cutoff = time.time() - FINISHED_JOB_TTL
+        while self.finished_ids:
+            job = self.jobs.get(self.finished_ids[0])
+            if job is not None and job.finished >= cutoff and len(self.finished_ids) <= MAX_FINISHED_JOBS:
+                break
+            self.finished_ids.popleft()
+            if job is not None:
+                del self.jobs[job.id]
+
+    def publish(self, job):
+        job.last_event = time.time()
+        self.events.publish(job.to_dict())
+
+    def on_progress(self, job, percent, speed):
+        job.percent = percent
+        job.speed = speed
+        if percent >= 100 or time.time() - job.last_event >= PROGRESS_INTERVAL:
+            self.publish(job)
+
+    def worker_loop(self):
+        while True:
+            job_id = self.queue.get()
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if job is None or job.status != QUEUED:
+                    continue
+                job.status = DOWNLOADING
+                job.task = DownloadTask(
+                    job.url, job.download_path, job.quality, job.download_type,
+                    format_index=job.format_index,
+                    policy=job.policy,
+                    write_buffer_kb=self.write_buffer_kb,
+                    preallocate_files=self.preallocate_files,
+                    ffmpeg_available=self.ffmpeg_available,
+                    ratelimit=self.job_rate_limit,
+                    on_progress=lambda percent, speed, job=job: self.on_progress(job, percent, speed),
+                    # Scripted jobs come without a format index; read the
+                    # formats first so the policy and space check apply
+                    extract_first=True
+                )
+            self.publish(job)
+            try:
+                job.filename = job.task.run()
+                job.percent = 100.0
+                status = COMPLETED
+            except DownloadCancelled:
+                status = CANCELLED
+            except Exception as e:
+                job.error = str(e)
+                status = FAILED
+            with self.lock:
+                self.finish(job, status)
+            self.publish(job)
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """Routes API requests to the DownloadEngine of the server"""
+
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def engine(self):
+        return self.server.engine
+
+    def log_message(self, format, *args):
+        pass  # Keep the console quiet, errors are reported in the responses
+
+    def authorize(self, needs_json=False):
+        """Reject requests that do not come from a local client holding the token.
+
+        The Host check stops DNS rebinding; the token and the JSON content
+        type stop web pages from sending "simple" cross-origin requests.
+        """
+        if not self.server.host_allowed(self.headers.get('Host', '')):
+            error, status = 'Host not allowed', 403
+        elif not hmac.compare_digest(self.headers.get('Authorization', '').encode('utf-8'),
+                                     f'Bearer {self.server.token}'.encode('utf-8')):
+            error, status = 'Missing or invalid token', 401
+        elif needs_json and self.headers.get('Content-Type', '').split(';')[0].strip().lower() != 'application/json':
+            error, status = 'Content-Type must be application/json', 415
+        else:
+            return True
+        # The request body was not read, so the connection cannot be reused
+        self.close_connection = True
+        self.send_json({'error': error}, status)
+        return False
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def route(self):
+        """Return (path parts, query parameters) of the request"""
+        parsed = urlparse(self.path)
+        return [p for p in parsed.path.split('/') if p], parse_qs(parsed.query)
+
+    def do_GET(self):
+        if not self.authorize():
+            return
+        parts, params = self.route()
+        if parts == ['health']:
+            self.send_json({
+                'status': 'ok',
+                'pid': os.getpid(),
+                'workers': self.engine.workers,
+                'ffmpeg': self.engine.ffmpeg_available,
+                'queued': self.engine.queue.qsize(),
+            })
+        elif parts == ['jobs']:
+            self.send_json([job.to_dict() for job in self.engine.list()])
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = self.engine.get(parts[1])
+            if job is None:
+                self.send_json({'error': 'Job not found'}, 404)
+            else:
+                self.send_json(job.to_dict())
+        elif parts == ['events']:
+            self.stream_events(params.get('job', [None])[0])
+        else:
+            self.send_json({'error': 'Not found'}, 404)
+
+    def do_POST(self):
+        if not self.authorize(needs_json=True):
+            return
+        parts, _ = self.route()
+        try:
+            body = self.read_json()
+            if parts == ['info']:
+                self.send_json(self.engine.info(body['url']))
+            elif parts == ['jobs']:
+                if isinstance(body, list):
+                    self.send_json([job.to_dict() for job in self.engine.submit_many(body)], 201)
+                else:
+                    self.send_json(self.engine.submit(body).to_dict(), 201)
+            else:
+                self.send_json({'error': 'Not found'}, 404)
+        except (ValueError, KeyError) as e:
+            self.send_json({'error': f'Bad request: {e}'}, 400)
+        except Exception as e:
+            self.send_json({'error': str(e)}, 500)
+
+    def do_DELETE(self):
+        if not self.authorize():
+            return
+        parts, _ = self.route()
+        if len(parts) == 2 and parts[0] == 'jobs':
+            job = self.engine.cancel(parts[1])
+            if job is None:
+                self.send_json({'error': 'Job not found'}, 404)
+            else:
+                self.send_json(job.to_dict())
+        else:
+            self.send_json({'error': 'Not found'}, 404)
+
+    def stream_events(self, job_id):
+        """Send job updates as Server-Sent Events until the client leaves"""
+        events = self.engine.events.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+
+            # Start with the current state so no update is missed
+            if job_id:
+                job = self.engine.get(job_id)
+                snapshot = [job.to_dict()] if job else []
+            else:
+                snapshot = [job.to_dict() for job in self.engine.list()
+                            if job.status not in FINAL_STATES]
+            for event in snapshot:
+                self.write_event(event)
+            if job_id and (not snapshot or snapshot[0]['status'] in FINAL_STATES):
+                return
+
+            while True:
+                try:
+                    event = events.get(timeout=15)
+                except queue.Empty:
+                    self.wfile.write(b': keep-alive\n\n')
+                    self.wfile.flush()
+                    continue
+                if job_id and event['id'] != job_id:
+                    continue
+                self.write_event(event)
+                if job_id and event['status'] in FINAL_STATES:
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.engine.events.unsubscribe(events)
+
+    def write_event(self, event):
+        self.wfile.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+        self.wfile.flush()
+
+
+class DaemonServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, engine, token):
+        super().__init__(address, DaemonRequestHandler)
+        self.engine = engine
+        self.token = token
+        host, port = self.server_address[:2]
+        self.allowed_hosts = {f'{name}:{port}'.lower()
+                              for name in ('127.0.0.1', 'localhost', '[::1]', host)}
+        # Bound to every interface: the machine's names are unknown, rely on the token
+        self.any_host = host in ('', '0.0.0.0', '::')
+
+    def host_allowed(self, host):
+        return self.any_host or host.lower() in self.allowed_hosts
+
+
+class DaemonClient:
+    """Small client for the daemon API, used by the desktop application"""
+
+    def __init__(self, base_url=DEFAULT_URL, timeout=30, token=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.token = token
+
+    def headers(self):
+        # Read the token file on every call, a newly started daemon creates it
+        return {'Authorization': f'Bearer {self.token or load_token()}'}
+
+    def request(self, method, path, **kwargs):
+        response = requests.request(method, self.base_url + path,
+                                    timeout=kwargs.pop('timeout', self.timeout),
+                                    headers=self.headers(), **kwargs)
+        data = response.json()
+        if response.status_code >= 400:
+            raise Exception(data.get('error', f'HTTP {response.status_code}'))
+        return data
+
+    def health(self):
+        return self.request('GET', '/health', timeout=2)
+
+    def is_running(self):
+        try:
+            self.health()
+            return True
+        except Exception:
+            return False
+
+    def info(self, url):
+        # Extraction can take a while for long videos
+        return self.request('POST', '/info', json={'url': url}, timeout=120)
+
+    def submit(self, url, **params):
+        return self.request('POST', '/jobs', json={'url': url, **params})
+
+    def submit_many(self, jobs):
+        return self.request('POST', '/jobs', json=jobs)
+
+    def get_job(self, job_id):
+        return self.request('GET', f'/jobs/{job_id}')
+
+    def list_jobs(self):
+        return self.request('GET', '/jobs')
+
+    def cancel(self, job_id):
+        return self.request('DELETE', f'/jobs/{job_id}')
+
+    def events(self, job_id=None):
+        """Yield job updates as they happen (ends when the job is final)"""
+        params = {'job': job_id} if job_id else {}
+        with requests.get(self.base_url + '/events', params=params,
+                          headers=self.headers(), stream=True,
+                          timeout=(5, None)) as response:
+            for line in response.iter_lines(decode_unicode=True):
+                if line and line.startswith('data: '):
+                    yield json.loads(line[len('data: '):])
+
+
+def start_local_daemon(base_url=DEFAULT_URL, wait=10):
+    """Start a daemon on this machine unless one is already answering.
+
+    Returns a DaemonClient, or None when the daemon could not be reached.
+    """
+    client = DaemonClient(base_url)
+    if client.is_running():
+        return client
+    parsed = urlparse(base_url)
+    if parsed.hostname not in ('127.0.0.1', 'localhost'):
+        return None
+
+    script = os.path.abspath(__file__)
+    subprocess.Popen(
+        [sys.executable, script, '--host', parsed.hostname,
+         '--port', str(parsed.port or DEFAULT_PORT)],
+        cwd=os.getcwd(),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        if client.is_running():
+            return client
+        time.sleep(0.2)
+    return None
+
+
+def load_token():
+    """Read the API token, or None if no daemon has created one yet"""
+    try:
+        with open(TOKEN_PATH, 'r') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def create_token():
+    """Return the API token, creating it with owner-only permissions if needed"""
+    token = load_token()
+    if token:
+        return token
+    os.makedirs(os.path.dirname(TOKEN_PATH), exist_ok=True)
+    token = secrets.token_urlsafe(32)
+    fd = os.open(TOKEN_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+
+def load_config():
+    """Read the settings shared with the desktop application"""
+    if os.path.exists(CONFIG_PATH):
+        try:
+            with open(CONFIG_PATH, 'r') as f:
+                return json.load(f)
+        except Exception:
+            pass
+    return {}
+
+
+def main():
+    config = load_config()
+    parser = argparse.ArgumentParser(description="YouTube downloader daemon")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=3,
+                        help="Number of simultaneous downloads")
+    parser.add_argument('--download-path',
+                        default=config.get('folder_path',
+                                           os.path.join(os.path.expanduser("~"), "Downloads")))
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help="Total download speed limit in KB/s (0 = no limit)")
+    parser.add_argument('--process-pool', action='store_true',
+                        default=config.get('process_pool_extraction', False),
+                        help="Extract video information in worker processes")
+    args = parser.parse_args()
+
+    engine = DownloadEngine(
+        args.download_path,
+        workers=args.workers,
+        rate_limit=args.rate_limit * 1024,
+        write_buffer_kb=config.get('write_buffer_kb', 0),
+        preallocate_files=config.get('preallocate', True),
+        policy={
+            'max_size': config.get('max_filesize_mb', 0) * 1024 * 1024 or None,
+            'max_tbr': config.get('max_bitrate_kbps', 0) or None,
+            'preferred_codec': config.get('preferred_codec', ''),
+        },
+        process_pool=args.process_pool
+    )
+    engine.start()
+
+    server = DaemonServer((args.host, args.port), engine, create_token())
+    print(f"Download daemon listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.stop()
+
+
+if __name__ == '__main__':
+    main()
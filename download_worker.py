@@ -0,0 +1,496 @@
+"""
+Download Worker
+Lets several processes, on one machine or on several machines sharing a
+folder, work through one download queue stored in a SQLite database.
+
+Workers claim jobs with a time-limited lease and renew it with heartbeats
+while downloading. When a worker dies its lease runs out and the job is
+claimed again by another worker. Jobs are unique per video ID, and files
+are named after the video ID, so a video is only downloaded once.
+
+The space each running job still needs is stored with the job, so free
+space is checked against the downloads of all workers, not only the
+worker's own.
+
+Usage:
+    python download_worker.py --db jobs.db enqueue URL [URL ...]
+    python download_worker.py --db jobs.db work --download-path DIR
+    python download_worker.py --db jobs.db status
+    python download_worker.py serve-media DIR --port 8000
+
+serve-media starts a plain HTTP server for local media files. Enqueue its
+URLs (http://127.0.0.1:8000/<file>) and start a few `work` processes to try
+the queue on one machine without contacting YouTube.
+
+Note: claiming a job relies on SQLite's file locking. SQLite's own
+documentation warns that locking on network filesystems (NFS, SMB) is
+often broken, and then two workers can claim the same job or corrupt the
+database. Multi-machine use is only safe on a filesystem whose locks are
+known to work; otherwise run all workers on the host that stores the
+database. Leases use wall-clock time, so keep them much longer than the
+clock difference between machines.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import sqlite3
+import argparse
+import threading
+from functools import partial
+from contextlib import contextmanager
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from downloader_core import (
+    DownloadTask, DownloadCancelled, InsufficientSpaceError, check_ffmpeg,
+    extract_video_id, format_size, FREE_SPACE_MARGIN
+)
+
+
+DEFAULT_DB = 'configurations/jobs.db'
+DEFAULT_LEASE = 60  # seconds
+MAX_ATTEMPTS = 3
+NO_SPACE_WAIT = 30  # seconds before a job that did not fit is tried again
+
+# Output names include the video ID so a finished file can be recognised
+WORKER_OUTTMPL = '%(title)s [%(id)s].%(ext)s'
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    download_type TEXT NOT NULL,
+    quality TEXT NOT NULL,
+    policy TEXT,
+    status TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    filename TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    download_path TEXT,
+    reserved_bytes INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    UNIQUE (video_id, download_type)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires);
+CREATE TABLE IF NOT EXISTS workers (
+    id TEXT PRIMARY KEY,
+    host TEXT,
+    pid INTEGER,
+    last_seen REAL
+);
+"""
+
+
+class JobTooLargeError(Exception):
+    """Raised when a job needs more space than the whole disk holds"""
+
+
+class JobStore:
+    """Shared job queue in a SQLite database.
+
+    Every call opens its own connection, so one store can be used from the
+    worker loop and its heartbeat thread at the same time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+            # Databases created before space accounting lack these columns
+            for column in ('download_path TEXT',
+                           'reserved_bytes INTEGER NOT NULL DEFAULT 0',
+                           'not_before REAL NOT NULL DEFAULT 0'):
+                try:
+                    db.execute(f'ALTER TABLE jobs ADD COLUMN {column}')
+                except sqlite3.OperationalError:
+                    pass  # Already there
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction that holds the database lock from the start"""
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+
+    def enqueue(self, url, download_type='video', quality='best', policy=None):
+        """Add a job unless the video is already queued or downloaded.
+
+        Returns (job id, added). Failed jobs for the same video are queued
+        again with a fresh attempt count.
+        """
+        video_id = extract_video_id(url)
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute(
+                'SELECT id, status FROM jobs WHERE video_id = ? AND download_type = ?',
+                (video_id, download_type)).fetchone()
+            if row is None:
+                cursor = db.execute(
+                    'INSERT INTO jobs (url, video_id, download_type, quality, policy,'
+                    ' status, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (url, video_id, download_type, str(quality),
+                     json.dumps(policy or {}), QUEUED, now, now))
+                return cursor.lastrowid, True
+            if row['status'] == FAILED:
+                db.execute(
+                    'UPDATE jobs SET status = ?, attempts = 0, error = NULL, worker = NULL,'
+                    ' updated = ? WHERE id = ?', (QUEUED, now, row['id']))
+                return row['id'], True
+            return row['id'], False
+
+    def claim(self, worker_id, lease=DEFAULT_LEASE):
+        """Lease the oldest waiting job, or one whose worker stopped renewing.
+
+        Jobs postponed with requeue() are skipped until their time has come.
+        """
+        now = time.time()
+        with self.transaction() as db:
+            while True:
+                row = db.execute(
+                    'SELECT * FROM jobs WHERE (status = ? AND not_before <= ?)'
+                    ' OR (status = ? AND lease_expires < ?) ORDER BY id LIMIT 1',
+                    (QUEUED, now, RUNNING, now)).fetchone()
+                if row is None:
+                    return None
+                if row['attempts'] < MAX_ATTEMPTS:
+                    break
+                # Its workers kept dying, do not try forever
+                db.execute(
+                    'UPDATE jobs SET status = ?, error = ?, lease_expires = NULL,'
+                    ' reserved_bytes = 0, updated = ? WHERE id = ?',
+                    (FAILED, 'Lease expired too many times', now, row['id']))
+            db.execute(
+                'UPDATE jobs SET status = ?, worker = ?, lease_expires = ?,'
+                ' attempts = attempts + 1, updated = ? WHERE id = ?',
+                (RUNNING, worker_id, now + lease, now, row['id']))
+            job = dict(row)
+            job['policy'] = json.loads(job['policy'] or '{}')
+            return job
+
+    def heartbeat(self, job_id, worker_id, lease=DEFAULT_LEASE):
+        """Renew a lease; returns False when the job was taken over"""
+        now = time.time()
+        with self.transaction() as db:
+            cursor = db.execute(
+                'UPDATE jobs SET lease_expires = ?, updated = ?'
+                ' WHERE id = ? AND worker = ? AND status = ?',
+                (now + lease, now, job_id, worker_id, RUNNING))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker_id, filename):
+        with self.transaction() as db:
+            db.execute(
+                'UPDATE jobs SET status = ?, filename = ?, error = NULL, reserved_bytes = 0,'
+                ' lease_expires = NULL, updated = ? WHERE id = ? AND worker = ?',
+                (COMPLETED, filename, time.time(), job_id, worker_id))
+
+    def fail(self, job_id, worker_id, error, retry=True):
+        """Record an error; the job is retried until MAX_ATTEMPTS is reached"""
+        attempts = MAX_ATTEMPTS if retry else 0
+        with self.transaction() as db:
+            db.execute(
+                'UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END,'
+                ' error = ?, reserved_bytes = 0, lease_expires = NULL, updated = ?'
+                ' WHERE id = ? AND worker = ?',
+                (attempts, FAILED, QUEUED, error, time.time(), job_id, worker_id))
+
+    def requeue(self, job_id, worker_id, delay=NO_SPACE_WAIT):
+        """Give a job back without counting the attempt.
+
+        The job is not claimed again for `delay` seconds, so the jobs queued
+        after it get their turn in the meantime.
+        """
+        now = time.time()
+        with self.transaction() as db:
+            db.execute(
+                'UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL,'
+                ' reserved_bytes = 0, attempts = MAX(attempts - 1, 0), not_before = ?,'
+                ' updated = ? WHERE id = ? AND worker = ?',
+                (QUEUED, now + delay, now, job_id, worker_id))
+
+    def reserve_space(self, job_id, worker_id, download_path, size):
+        """Admit a job if it fits next to the RUNNING jobs of every worker.
+
+        Raises InsufficientSpaceError, or JobTooLargeError when the job could
+        not fit even on an empty disk. Jobs whose lease expired do not count,
+        their worker is gone.
+        """
+        path = os.path.realpath(download_path)
+        os.makedirs(path, exist_ok=True)
+        usage = shutil.disk_usage(path)
+        if size > usage.total - FREE_SPACE_MARGIN:
+            raise JobTooLargeError(
+                f"Needs {format_size(size)}, more than the {format_size(usage.total)} "
+                f"disk holding {path}")
+        now = time.time()
+        with self.transaction() as db:
+            reserved = db.execute(
+                'SELECT COALESCE(SUM(reserved_bytes), 0) FROM jobs WHERE status = ?'
+                ' AND lease_expires >= ? AND download_path = ? AND id != ?',
+                (RUNNING, now, path, job_id)).fetchone()[0]
+            available = usage.free - reserved - FREE_SPACE_MARGIN
+            if size > available:
+                raise InsufficientSpaceError(
+                    f"Not enough free space in {path}: need {format_size(size)}, "
+                    f"{format_size(max(available, 0))} available")
+            db.execute(
+                'UPDATE jobs SET download_path = ?, reserved_bytes = ? WHERE id = ? AND worker = ?',
+                (path, size, job_id, worker_id))
+
+    def set_reserved(self, job_id, worker_id, size):
+        with self.transaction() as db:
+            db.execute('UPDATE jobs SET reserved_bytes = ? WHERE id = ? AND worker = ?',
+                       (size, job_id, worker_id))
+
+    def pending(self):
+        """Number of jobs that are waiting or running"""
+        with self.connect() as db:
+            return db.execute('SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)',
+                              (QUEUED, RUNNING)).fetchone()[0]
+
+    def register_worker(self, worker_id):
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO workers (id, host, pid, last_seen) VALUES (?, ?, ?, ?)',
+                (worker_id, socket.gethostname(), os.getpid(), time.time()))
+
+    def counts(self):
+        with self.connect() as db:
+            return dict(db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def jobs(self):
+        with self.connect() as db:
+            return [dict(row) for row in db.execute('SELECT * FROM jobs ORDER BY id')]
+
+    def workers(self):
+        with self.connect() as db:
+            return [dict(row) for row in db.execute('SELECT * FROM workers ORDER BY id')]
+
+
+class SharedSpaceReservations:
+    """Free-space admission shared by every worker writing to one folder.
+
+    Used in place of downloader_core.space_reservations, which only knows
+    about the downloads of its own process. The reservation is stored on
+    the job row, so space still needed by RUNNING jobs of other workers is
+    counted. Folders are compared by path, so machines must mount the
+    shared folder at the same path.
+    """
+
+    UPDATE_INTERVAL = 5  # seconds between database writes of the remaining size
+
+    def __init__(self, store, job_id, worker_id):
+        self.store = store
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.last_update = 0.0
+
+    def reserve(self, path, size):
+        self.store.reserve_space(self.job_id, self.worker_id, path, size)
+        return self.job_id
+
+    def update(self, token, remaining):
+        # Called on every progress update, only write now and then
+        now = time.time()
+        if now - self.last_update >= self.UPDATE_INTERVAL:
+            self.last_update = now
+            self.store.set_reserved(token, self.worker_id, max(0, remaining))
+
+    def release(self, token):
+        try:
+            self.store.set_reserved(token, self.worker_id, 0)
+        except sqlite3.Error:
+            pass  # complete() and fail() clear it as well
+
+
+class Worker:
+    """Claims jobs from a JobStore and downloads them one at a time"""
+
+    def __init__(self, store, download_path, worker_id=None, lease=DEFAULT_LEASE,
+                 poll_interval=2, write_buffer_kb=0, preallocate_files=True):
+        self.store = store
+        self.download_path = download_path
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.write_buffer_kb = write_buffer_kb
+        self.preallocate_files = preallocate_files
+        self.ffmpeg_available = check_ffmpeg()
+        self.stop_event = threading.Event()
+
+    def log(self, message):
+        print(f"[{self.worker_id}] {message}")
+        sys.stdout.flush()
+
+    def run(self, exit_when_idle=False):
+        self.store.register_worker(self.worker_id)
+        self.log("started")
+        while not self.stop_event.is_set():
+            job = self.store.claim(self.worker_id, self.lease)
+            if job is None:
+                if exit_when_idle and not self.store.pending():
+                    break
+                self.store.register_worker(self.worker_id)
+                self.stop_event.wait(self.poll_interval)
+                continue
+            self.process(job)
+        self.log("stopped")
+
+    def heartbeat_loop(self, job, task, done):
+        """Renew the lease until the job ends; stop the download if it is lost"""
+        while not done.wait(self.lease / 3):
+            try:
+                self.store.register_worker(self.worker_id)
+                alive = self.store.heartbeat(job['id'], self.worker_id, self.lease)
+            except sqlite3.Error:
+                continue  # Database busy, try again on the next beat
+            if not alive:
+                self.log(f"lost lease on job {job['id']}")
+                task.cancel()
+                return
+
+    def process(self, job):
+        self.log(f"job {job['id']}: {job['url']} (attempt {job['attempts'] + 1})")
+        task = DownloadTask(
+            job['url'], self.download_path, job['quality'], job['download_type'],
+            policy=job['policy'],
+            write_buffer_kb=self.write_buffer_kb,
+            preallocate_files=self.preallocate_files,
+            ffmpeg_available=self.ffmpeg_available,
+            outtmpl=WORKER_OUTTMPL,
+            # Partial files stay private to this worker; a worker that lost
+            # its lease cannot append to the file of the one that took over
+            temp_owner=self.worker_id,
+            reservations=SharedSpaceReservations(self.store, job['id'], self.worker_id),
+            extract_first=True
+        )
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat_loop,
+                                     args=(job, task, done), daemon=True)
+        heartbeat.start()
+        try:
+            filename = task.run()
+            self.store.complete(job['id'], self.worker_id, filename)
+            self.log(f"job {job['id']} completed: {filename}")
+        except DownloadCancelled:
+            pass  # The job now belongs to another worker
+        except InsufficientSpaceError as e:
+            # Not the job's fault; try it again once running downloads finish
+            self.store.requeue(job['id'], self.worker_id)
+            self.log(f"job {job['id']} postponed: {e}")
+        except JobTooLargeError as e:
+            self.store.fail(job['id'], self.worker_id, str(e), retry=False)
+            self.log(f"job {job['id']} failed: {e}")
+        except Exception as e:
+            self.store.fail(job['id'], self.worker_id, str(e))
+            self.log(f"job {job['id']} failed: {e}")
+        finally:
+            done.set()
+            heartbeat.join()
+
+
+def serve_media(folder, host, port):
+    """Serve files from folder over HTTP as a stand-in for the video site"""
+    handler = partial(SimpleHTTPRequestHandler, directory=folder)
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Serving {folder} on http://{host}:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared-queue download worker")
+    parser.add_argument('--db', default=DEFAULT_DB, help="Path of the shared job database")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    enqueue = commands.add_parser('enqueue', help="Add URLs to the queue")
+    enqueue.add_argument('urls', nargs='*')
+    enqueue.add_argument('--file', help="File with one URL per line")
+    enqueue.add_argument('--type', choices=('video', 'audio'), default='video')
+    enqueue.add_argument('--quality', default='best')
+
+    work = commands.add_parser('work', help="Download jobs from the queue")
+    work.add_argument('--download-path',
+                      default=os.path.join(os.path.expanduser("~"), "Downloads"))
+    work.add_argument('--worker-id')
+    work.add_argument('--lease', type=int, default=DEFAULT_LEASE,
+                      help="Seconds before an unrenewed job is given to another worker")
+    work.add_argument('--exit-when-idle', action='store_true',
+                      help="Stop when no job is waiting or running")
+
+    commands.add_parser('status', help="Show queue and worker status")
+
+    media = commands.add_parser('serve-media', help="Serve local files for testing")
+    media.add_argument('folder')
+    media.add_argument('--host', default='127.0.0.1')
+    media.add_argument('--port', type=int, default=8000)
+
+    args = parser.parse_args()
+
+    if args.command == 'serve-media':
+        serve_media(args.folder, args.host, args.port)
+        return
+
+    store = JobStore(args.db)
+
+    if args.command == 'enqueue':
+        urls = list(args.urls)
+        if args.file:
+            with open(args.file, 'r') as f:
+                urls.extend(line.strip() for line in f if line.strip())
+        for url in urls:
+            job_id, added = store.enqueue(url, args.type, args.quality)
+            print(f"{'queued' if added else 'already known'}: job {job_id} {url}")
+
+    elif args.command == 'work':
+        worker = Worker(store, args.download_path, args.worker_id, args.lease)
+        try:
+            worker.run(args.exit_when_idle)
+        except KeyboardInterrupt:
+            pass
+
+    elif args.command == 'status':
+        print(json.dumps(store.counts(), indent=2))
+        for job in store.jobs():
+            print(f"{job['id']:>6} {job['status']:<10} {job['worker'] or '-':<24} "
+                  f"{job['video_id']} {job['filename'] or job['error'] or ''}")
+        for worker in store.workers():
+            print(f"worker {worker['id']} on {worker['host']}, "
+                  f"last seen {time.time() - worker['last_seen']:.0f}s ago")
+
+
+if __name__ == '__main__':
+    main()
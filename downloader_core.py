@@ -0,0 +1,685 @@
+"""
+Download engine shared by the desktop application and the command line tools.
+Contains the yt-dlp helpers that do not depend on PyQt5.
+"""
+
+import os
+import re
+import sys
+import shutil
+import subprocess
+import ctypes
+import ctypes.util
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import yt_dlp
+
+
+HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept-Encoding': 'gzip, deflate',
+    'DNT': '1',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1'
+}
+
+INFO_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': False,
+    'socket_timeout': 30,
+    'http_headers': HTTP_HEADERS,
+    'cookiefile': None,  # Will be set in downloader
+    'noplaylist': True,
+}
+
+
+# Covers watch?v=, youtu.be/, shorts/, live/, embed/ and clip/ URLs
+VIDEO_ID_RE = re.compile(
+    r'(?:[?&]v=|youtu\.be/|/(?:shorts|live|embed|v|clip)/)([A-Za-z0-9_-]{6,})')
+
+
+def extract_video_id(url):
+    """Return the video ID of a YouTube URL without contacting the site.
+
+    Any other URL (direct media links, playlists, channel pages) is returned
+    whole, minus its #fragment, so two different URLs never share an ID.
+    """
+    if 'youtube.com' in url or 'youtu.be' in url:
+        match = VIDEO_ID_RE.search(url)
+        if match:
+            return match.group(1)
+    return url.split('#')[0]
+
+
+def detect_video_type(url, info):
+    """Classify a video from its URL and extracted metadata"""
+    if '/shorts/' in url:
+        return "YouTube Short"
+    if '/clip/' in url or info.get('extractor') == 'youtube:clip':
+        return "YouTube Clip"
+    if info.get('is_live'):
+        return "Live Stream (Active)"
+    if info.get('was_live'):
+        return "Live Stream (Recorded)"
+    return "Regular Video"
+
+
+# Prefixes yt-dlp uses in 'vcodec' for each codec family
+CODEC_FAMILIES = {
+    'h264': ('avc1', 'h264'),
+    'vp9': ('vp9', 'vp09'),
+    'av1': ('av01',),
+}
+
+
+def codec_family(vcodec):
+    """Map a yt-dlp vcodec string such as 'avc1.640028' to its family name"""
+    for family, prefixes in CODEC_FAMILIES.items():
+        if vcodec.startswith(prefixes):
+            return family
+    return vcodec.split('.')[0]
+
+
+def format_size(size):
+    """Format a byte count for display"""
+    if size is None:
+        return "unknown size"
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.2f} GB"
+
+
+def estimate_filesize(fmt, duration):
+    """Return (size, estimated) for a yt-dlp format dict.
+
+    Uses the exact filesize when the site reports it, then yt-dlp's own
+    approximation, then the total bitrate multiplied by the duration.
+    """
+    if fmt.get('filesize'):
+        return int(fmt['filesize']), False
+    if fmt.get('filesize_approx'):
+        return int(fmt['filesize_approx']), True
+    if fmt.get('tbr') and duration:
+        return int(fmt['tbr'] * 1000 / 8 * duration), True
+    return None, True
+
+
+def build_format_index(info, duration):
+    """Keep the fields needed to pick a format without the full info dict"""
+    index = []
+    for fmt in info.get('formats') or []:
+        vcodec = fmt.get('vcodec') or 'none'
+        acodec = fmt.get('acodec') or 'none'
+        if vcodec == 'none' and acodec == 'none':
+            continue  # Storyboards and other non-media entries
+        size, estimated = estimate_filesize(fmt, duration)
+        index.append({
+            'format_id': fmt.get('format_id'),
+            'ext': fmt.get('ext'),
+            'vcodec': vcodec,
+            'acodec': acodec,
+            'height': fmt.get('height'),
+            'fps': fmt.get('fps'),
+            'tbr': fmt.get('tbr'),
+            'filesize': size,
+            'size_estimated': estimated,
+        })
+    return index
+
+
+def _combine(formats):
+    """Total size and bitrate of formats downloaded together"""
+    sizes = [f['filesize'] for f in formats]
+    rates = [f['tbr'] for f in formats]
+    size = None if None in sizes else sum(sizes)
+    tbr = None if None in rates else sum(rates)
+    return size, tbr
+
+
+def _fits(formats, policy):
+    """Check a format combination against the size/bitrate policy"""
+    size, tbr = _combine(formats)
+    if policy.get('max_size') and (size is None or size > policy['max_size']):
+        return False
+    if policy.get('max_tbr') and (tbr is None or tbr > policy['max_tbr']):
+        return False
+    return True
+
+
+def _selection(formats):
+    size, _ = _combine(formats)
+    return {
+        'format': '+'.join(f['format_id'] for f in formats),
+        'height': formats[0].get('height'),
+        'filesize': size,
+        'size_estimated': any(f['size_estimated'] for f in formats),
+    }
+
+
+def select_format(format_index, quality='best', download_type='video',
+                  merge=True, policy=None, allow_lower=True):
+    """Pick formats from the index according to a bandwidth policy.
+
+    policy may contain 'max_size' (bytes), 'max_tbr' (kbit/s) and
+    'preferred_codec' (a CODEC_FAMILIES key). For video, the requested
+    height is tried first and, if nothing fits and allow_lower is set,
+    lower heights next. With a size or bitrate limit the smallest download
+    at that height wins; without one the highest frame rate and bitrate do.
+    Audio picks the highest bitrate that fits. Returns a dict with the
+    yt-dlp format string and the expected size, or None when nothing fits.
+    """
+    policy = policy or {}
+    audio = [f for f in format_index if f['vcodec'] == 'none' and f['acodec'] != 'none']
+    audio.sort(key=lambda f: f['tbr'] or 0, reverse=True)
+
+    if download_type == 'audio':
+        for fmt in audio:
+            if _fits([fmt], policy):
+                return _selection([fmt])
+        return None
+
+    options = [[f] for f in format_index
+               if f['height'] and f['vcodec'] != 'none' and f['acodec'] != 'none']
+    if merge:
+        for video in format_index:
+            if not video['height'] or video['vcodec'] == 'none' or video['acodec'] != 'none':
+                continue
+            # Pair each video stream with the best audio stream that still fits
+            for fmt in audio:
+                if _fits([video, fmt], policy):
+                    options.append([video, fmt])
+                    break
+
+    options = [o for o in options if _fits(o, policy)]
+    heights = sorted({o[0]['height'] for o in options}, reverse=True)
+    if quality != 'best':
+        heights = [h for h in heights if h <= int(quality)]
+    if not allow_lower:
+        heights = heights[:1]
+        if quality != 'best' and heights and heights[0] != int(quality):
+            return None
+
+    for height in heights:
+        candidates = [o for o in options if o[0]['height'] == height]
+        preferred = [o for o in candidates
+                     if codec_family(o[0]['vcodec']) == policy.get('preferred_codec')]
+        if preferred:
+            candidates = preferred
+        if policy.get('max_size') or policy.get('max_tbr'):
+            best = min(candidates, key=lambda o: _combine(o)[0] or float('inf'))
+        else:
+            best = max(candidates, key=lambda o: (o[0]['fps'] or 0, _combine(o)[1] or 0))
+        return _selection(best)
+    return None
+
+
+def build_video_data(url, info):
+    """Reduce a yt-dlp info dict to the compact record used by the UI.
+
+    The record only holds plain str/float/int/list values so it can be
+    pickled cheaply when it comes back from a worker process.
+    """
+    formats = []
+    if info.get('formats'):
+        for fmt in info['formats']:
+            if fmt.get('height'):
+                formats.append(fmt['height'])
+        formats = sorted(list(set(formats)), reverse=True)
+
+    duration_value = info.get('duration', 0)
+    try:
+        duration_value = float(duration_value) if duration_value is not None else 0.0
+    except Exception:
+        duration_value = 0.0
+
+    return {
+        'title': info.get('title', 'Unknown'),
+        'thumbnail': info.get('thumbnail', ''),
+        'duration': duration_value,
+        'uploader': info.get('uploader', 'Unknown'),
+        'video_type': detect_video_type(url, info),
+        'formats': formats,
+        'format_index': build_format_index(info, duration_value),
+        'url': url
+    }
+
+
+def extract_video_info(url, ydl=None):
+    """Fetch metadata for a single URL and return the compact record"""
+    if ydl is not None:
+        return build_video_data(url, ydl.extract_info(url, download=False))
+    with yt_dlp.YoutubeDL(INFO_OPTS) as ydl:
+        return build_video_data(url, ydl.extract_info(url, download=False))
+
+
+# --- Process pool extraction -------------------------------------------------
+#
+# Signature/nsig decoding and JSON parsing inside extract_info are pure Python
+# and hold the GIL, so several QThread fetchers end up running one at a time
+# and starve the GUI thread. The pool below moves that work into separate
+# processes. Each worker keeps one YoutubeDL instance alive, which keeps the
+# extractor's player JS caches warm between requests.
+
+_worker_ydl = None
+
+_pool = None
+_pool_size = None
+_pool_lock = threading.Lock()
+
+
+def _init_extraction_worker():
+    """Create the long-lived YoutubeDL instance for this worker process"""
+    global _worker_ydl
+    _worker_ydl = yt_dlp.YoutubeDL(INFO_OPTS)
+
+
+def _extract_in_worker(url):
+    """Entry point executed inside a pool worker"""
+    if _worker_ydl is None:
+        _init_extraction_worker()
+    return extract_video_info(url, _worker_ydl)
+
+
+def _warm_up():
+    return os.getpid()
+
+
+def get_extraction_pool(max_workers=None):
+    """Return the shared extraction pool, starting it on first use"""
+    global _pool, _pool_size
+    with _pool_lock:
+        if _pool is None:
+            if max_workers is None:
+                max_workers = _pool_size or min(4, os.cpu_count() or 1)
+            _pool_size = max_workers
+            # Spawn rather than fork: the pool is started from a process that
+            # already runs Qt and other threads, and forking those can deadlock.
+            # Spawn is also what Windows always uses
+            _pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_extraction_worker
+            )
+            # Spawn the workers now instead of on the first user request
+            for _ in range(max_workers):
+                _pool.submit(_warm_up)
+        return _pool
+
+
+def _discard_pool(pool):
+    """Forget a broken pool so the next call starts a new one"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def extract_video_info_in_pool(url, timeout=None):
+    """Run extract_video_info in the shared process pool and wait for it"""
+    pool = get_extraction_pool()
+    try:
+        return pool.submit(_extract_in_worker, url).result(timeout=timeout)
+    except BrokenProcessPool:
+        # A worker died (out of memory, extractor crash) and the executor
+        # refuses all further work; replace it and try once more
+        _discard_pool(pool)
+        return get_extraction_pool().submit(_extract_in_worker, url).result(timeout=timeout)
+
+
+def shutdown_extraction_pool():
+    """Stop the shared extraction pool if it was started"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+            _pool = None
+
+
+# --- Output writing ----------------------------------------------------------
+
+# Partial files live in this folder inside the download folder, so they are on
+# the same filesystem and the final move is an atomic rename
+TEMP_DIR_NAME = '.partial'
+
+# Kept free on top of the estimated size (temporary files, metadata, ...)
+FREE_SPACE_MARGIN = 50 * 1024 * 1024
+
+FALLOC_FL_KEEP_SIZE = 0x01
+
+DEFAULT_OUTTMPL = '%(title)s.%(ext)s'
+
+_libc = None
+
+
+class InsufficientSpaceError(Exception):
+    """Raised when a download does not fit in the free disk space"""
+
+
+def get_temp_dir(download_path, owner=None):
+    """Folder where unfinished downloads are written.
+
+    Processes sharing a download folder pass an owner name so each one gets
+    its own subfolder and never appends to another process's partial file.
+    """
+    temp_dir = os.path.join(download_path, TEMP_DIR_NAME)
+    if owner:
+        temp_dir = os.path.join(temp_dir, re.sub(r'[^A-Za-z0-9._-]', '_', owner))
+    return temp_dir
+
+
+def output_opts(download_path, write_buffer_kb=0, outtmpl=DEFAULT_OUTTMPL,
+                temp_owner=None):
+    """yt-dlp options that write to the temp folder and move when complete.
+
+    write_buffer_kb fixes the size of each read/write block (0 keeps the
+    yt-dlp default, which starts small and grows with the transfer speed).
+    """
+    opts = {
+        'paths': {'home': download_path,
+                  'temp': get_temp_dir(download_path, temp_owner)},
+        'outtmpl': outtmpl,
+    }
+    if write_buffer_kb:
+        opts['buffersize'] = write_buffer_kb * 1024
+        opts['noresizebuffer'] = True
+    return opts
+
+
+def preallocate(path, size):
+    """Reserve disk blocks for a file that is being downloaded.
+
+    Uses fallocate with FALLOC_FL_KEEP_SIZE, so the apparent file size is not
+    changed and resuming a partial download still works. Only available on
+    Linux; returns False when the space could not be preallocated.
+    """
+    global _libc
+    if not sys.platform.startswith('linux') or not size:
+        return False
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                                        ctypes.c_longlong, ctypes.c_longlong]
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            return _libc.fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) == 0
+        finally:
+            os.close(fd)
+    except Exception:
+        return False
+
+
+def estimate_required_space(size, postprocess):
+    """Disk space needed to download `size` bytes.
+
+    Merging or converting keeps the inputs until the output is written,
+    so those jobs need about twice the download size at their peak.
+    """
+    if not size:
+        return 0
+    return size * 2 if postprocess else size
+
+
+class SpaceReservations:
+    """Tracks disk space promised to downloads that have not finished yet"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reserved = {}  # token -> (device, bytes)
+        self._next_token = 0
+
+    def _device(self, path):
+        os.makedirs(path, exist_ok=True)
+        return os.stat(path).st_dev
+
+    def reserved(self, path):
+        """Bytes reserved on the filesystem that holds path"""
+        device = self._device(path)
+        with self._lock:
+            return sum(size for dev, size in self._reserved.values() if dev == device)
+
+    def reserve(self, path, size):
+        """Admit a job needing `size` bytes in path or raise InsufficientSpaceError"""
+        device = self._device(path)
+        free = shutil.disk_usage(path).free
+        with self._lock:
+            reserved = sum(s for dev, s in self._reserved.values() if dev == device)
+            available = free - reserved - FREE_SPACE_MARGIN
+            if size > available:
+                raise InsufficientSpaceError(
+                    f"Not enough free space in {path}: need {format_size(size)}, "
+                    f"{format_size(max(available, 0))} available")
+            self._next_token += 1
+            self._reserved[self._next_token] = (device, size)
+            return self._next_token
+
+    def update(self, token, remaining):
+        """Shrink a reservation as its data is written to disk"""
+        with self._lock:
+            if token in self._reserved:
+                device, size = self._reserved[token]
+                self._reserved[token] = (device, max(0, min(size, remaining)))
+
+    def release(self, token):
+        with self._lock:
+            self._reserved.pop(token, None)
+
+
+space_reservations = SpaceReservations()
+
+
+# --- Downloading -------------------------------------------------------------
+
+class DownloadCancelled(Exception):
+    """Raised when a download is stopped with DownloadTask.cancel()"""
+
+
+def check_ffmpeg():
+    """Check if FFmpeg is available in the system"""
+    try:
+        subprocess.run(['ffmpeg', '-version'],
+                       capture_output=True,
+                       check=True,
+                       timeout=5)
+        return True
+    except Exception:
+        return False
+
+
+class DownloadTask:
+    """A single download, independent of the user interface.
+
+    on_progress(percent, speed_str) is called from the downloading thread.
+    Pass ffmpeg_available to skip probing for FFmpeg on every download.
+    reservations replaces the in-process space_reservations, and
+    extract_first reads the formats before reserving space when no
+    format_index was given (otherwise the size of such jobs is unknown).
+    """
+
+    def __init__(self, url, download_path, quality='best', download_type='video',
+                 format_index=None, policy=None, write_buffer_kb=0,
+                 preallocate_files=True, ffmpeg_available=None, ratelimit=None,
+                 on_progress=None, outtmpl=DEFAULT_OUTTMPL, temp_owner=None,
+                 reservations=None, extract_first=False):
+        self.url = url
+        self.download_path = download_path
+        self.quality = quality
+        self.download_type = download_type
+        self.format_index = format_index or []
+        self.policy = policy or {}
+        self.write_buffer_kb = write_buffer_kb
+        self.preallocate_files = preallocate_files
+        self.ffmpeg_available = ffmpeg_available
+        self.ratelimit = ratelimit
+        self.on_progress = on_progress
+        self.outtmpl = outtmpl
+        self.temp_owner = temp_owner
+        self.reservations = reservations or space_reservations
+        self.extract_first = extract_first
+        self.cancel_event = threading.Event()
+        self.reservation = None
+        self.required_space = 0
+        self.written = {}  # partial file -> bytes downloaded
+
+    def cancel(self):
+        """Stop the download at the next progress update"""
+        self.cancel_event.set()
+
+    def report(self, percent, speed_str):
+        if self.on_progress:
+            self.on_progress(percent, speed_str)
+
+    def progress_hook(self, d):
+        if self.cancel_event.is_set():
+            raise DownloadCancelled("Download cancelled")
+        if d['status'] == 'downloading':
+            try:
+                total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
+                downloaded = d.get('downloaded_bytes', 0)
+                tmpfilename = d.get('tmpfilename')
+                if tmpfilename:
+                    # Exact sizes only, estimates may be far too large
+                    if (self.preallocate_files and tmpfilename not in self.written
+                            and d.get('total_bytes')):
+                        preallocate(tmpfilename, d['total_bytes'])
+                    self.written[tmpfilename] = downloaded
+                    if self.reservation is not None:
+                        self.reservations.update(
+                            self.reservation,
+                            self.required_space - sum(self.written.values()))
+                if total > 0:
+                    percent = (downloaded / total) * 100
+                    speed = d.get('speed', 0)
+                    speed_str = f"{speed / 1024 / 1024:.2f} MB/s" if speed else "calculating..."
+                    self.report(percent, speed_str)
+            except Exception:
+                pass
+        elif d['status'] == 'finished':
+            self.report(100, "Processing...")
+
+    def build_opts(self, ffmpeg_available):
+        """Build the yt-dlp options, reserving disk space for the download"""
+        # Base options with anti-blocking measures
+        base_opts = {
+            'quiet': False,
+            'no_warnings': False,
+            'socket_timeout': 30,
+            'http_headers': HTTP_HEADERS,
+            'cookiefile': os.path.join(self.download_path, 'cookies.txt'),
+            'noplaylist': True,
+            'progress_hooks': [self.progress_hook],
+        }
+        if self.ratelimit:
+            base_opts['ratelimit'] = self.ratelimit
+
+        # Pick exact formats from the index when possible, the generic
+        # selectors below are kept as a fallback
+        selection = None
+        if self.format_index:
+            selection = select_format(self.format_index, self.quality,
+                                      self.download_type, ffmpeg_available,
+                                      self.policy)
+            if not selection and (self.policy.get('max_size') or self.policy.get('max_tbr')):
+                raise Exception("No format fits the configured size/bitrate limit")
+
+        # Make sure the download fits next to the ones already running
+        if selection:
+            postprocess = ffmpeg_available and (
+                self.download_type == 'audio' or '+' in selection['format'])
+            self.required_space = estimate_required_space(selection['filesize'], postprocess)
+        self.reservation = self.reservations.reserve(self.download_path, self.required_space)
+
+        # Write into the temp folder, finished files are moved into place
+        base_opts.update(output_opts(self.download_path, self.write_buffer_kb,
+                                     self.outtmpl, self.temp_owner))
+
+        # Configure download options based on type
+        if self.download_type == 'audio':
+            audio_format = 'bestaudio/best'
+            if selection:
+                audio_format = f"{selection['format']}/{audio_format}"
+
+            if ffmpeg_available:
+                # With FFmpeg: convert to MP3
+                return {
+                    **base_opts,
+                    'format': audio_format,
+                    'postprocessors': [{
+                        'key': 'FFmpegExtractAudio',
+                        'preferredcodec': 'mp3',
+                        'preferredquality': '192',
+                    }],
+                }
+            # Without FFmpeg: download best audio format (usually m4a/webm)
+            return {
+                **base_opts,
+                'format': audio_format,
+            }
+
+        if self.quality == 'best':
+            format_str = 'bestvideo+bestaudio/best' if ffmpeg_available else 'best'
+        else:
+            if ffmpeg_available:
+                format_str = f'bestvideo[height<={self.quality}]+bestaudio/best[height<={self.quality}]'
+            else:
+                format_str = f'best[height<={self.quality}]'
+
+        if selection:
+            format_str = f"{selection['format']}/{format_str}"
+
+        ydl_opts = {
+            **base_opts,
+            'format': format_str,
+        }
+
+        # Only merge if FFmpeg is available
+        if ffmpeg_available:
+            ydl_opts['merge_output_format'] = 'mp4'
+        return ydl_opts
+
+    def run(self):
+        """Download the video and return the path of the finished file"""
+        ffmpeg_available = self.ffmpeg_available
+        if ffmpeg_available is None:
+            ffmpeg_available = check_ffmpeg()
+
+        try:
+            info = None
+            if self.extract_first and not self.format_index:
+                # Learn the format sizes before reserving space; the same info
+                # is then downloaded, so the site is only queried once.
+                # yt-dlp saves the cookie file on exit, so its folder must exist
+                os.makedirs(self.download_path, exist_ok=True)
+                with yt_dlp.YoutubeDL({**INFO_OPTS, 'cookiefile': os.path.join(
+                        self.download_path, 'cookies.txt')}) as ydl:
+                    info = ydl.extract_info(self.url, download=False)
+                self.format_index = build_format_index(info, info.get('duration') or 0)
+
+            ydl_opts = self.build_opts(ffmpeg_available)
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                if info is None:
+                    info = ydl.extract_info(self.url, download=True)
+                else:
+                    info = ydl.process_ie_result(info, download=True)
+                filename = ydl.prepare_filename(info)
+                if self.download_type == 'audio' and ffmpeg_available:
+                    # Converted to mp3; without FFmpeg the file keeps its
+                    # downloaded extension (usually m4a/webm)
+                    filename = os.path.splitext(filename)[0] + '.mp3'
+                return filename
+        except Exception:
+            # yt-dlp may wrap the exception raised from the progress hook
+            if self.cancel_event.is_set():
+                raise DownloadCancelled("Download cancelled")
+            raise
+        finally:
+            if self.reservation is not None:
+                self.reservations.release(self.reservation)
+                self.reservation = None
@@ -0,0 +1,177 @@
+"""
+End-to-end check of the shared-queue worker mode.
+
+Starts serve-media as a stand-in for the video site and several
+`work --exit-when-idle` processes against a temporary database, then checks
+that every job is downloaded exactly once and that the job of a killed
+worker is taken over once its lease runs out.
+
+Run with:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import time
+import socket
+import signal
+import tempfile
+import threading
+import unittest
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import yt_dlp  # noqa: F401
+except ImportError:
+    yt_dlp = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if yt_dlp is not None:
+    from download_worker import JobStore, COMPLETED, RUNNING
+
+WORKER_SCRIPT = os.path.join(ROOT, 'download_worker.py')
+LEASE = 2  # seconds, short so the takeover test does not wait long
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(condition, timeout, message):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return
+        time.sleep(0.1)
+    raise AssertionError(message)
+
+
+class SlowMediaHandler(BaseHTTPRequestHandler):
+    """Serves a small video file slowly, so a download can be interrupted"""
+
+    data = os.urandom(256 * 1024)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(len(self.data)))
+        self.end_headers()
+        try:
+            for start in range(0, len(self.data), 8192):
+                self.wfile.write(self.data[start:start + 8192])
+                time.sleep(0.1)
+        except OSError:
+            pass  # The client went away
+
+
+@unittest.skipIf(yt_dlp is None, "yt-dlp is not installed")
+class WorkerModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.db_path = os.path.join(self.tmp.name, 'jobs.db')
+        self.download_path = os.path.join(self.tmp.name, 'downloads')
+        self.processes = []
+        self.addCleanup(self.stop_processes)
+
+    def stop_processes(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+    def start(self, *args, log_name=None):
+        log = subprocess.DEVNULL
+        if log_name:
+            log = open(os.path.join(self.tmp.name, log_name), 'w')
+            self.addCleanup(log.close)
+        process = subprocess.Popen([sys.executable, WORKER_SCRIPT, *args],
+                                   cwd=self.tmp.name, stdout=log,
+                                   stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        return process
+
+    def start_worker(self, name):
+        return self.start('--db', self.db_path, 'work',
+                          '--download-path', self.download_path,
+                          '--worker-id', name, '--lease', str(LEASE),
+                          '--exit-when-idle', log_name=f'{name}.log')
+
+    def read_log(self, name):
+        with open(os.path.join(self.tmp.name, f'{name}.log')) as f:
+            return f.read()
+
+    def test_each_job_is_downloaded_once(self):
+        media = os.path.join(self.tmp.name, 'media')
+        os.makedirs(media)
+        names = [f'sample{i}.mp4' for i in range(6)]
+        for name in names:
+            with open(os.path.join(media, name), 'wb') as f:
+                f.write(os.urandom(64 * 1024))
+
+        port = free_port()
+        self.start('serve-media', media, '--port', str(port))
+        base = f'http://127.0.0.1:{port}/'
+        wait_for(lambda: socket.socket().connect_ex(('127.0.0.1', port)) == 0,
+                 10, "serve-media did not start")
+
+        store = JobStore(self.db_path)
+        for name in names:
+            store.enqueue(base + name)
+        _, added = store.enqueue(base + names[0])
+        self.assertFalse(added, "a queued URL was queued a second time")
+
+        workers = [f'w{i}' for i in range(3)]
+        processes = [self.start_worker(name) for name in workers]
+        for process in processes:
+            process.wait(timeout=120)
+
+        jobs = store.jobs()
+        self.assertEqual(len(jobs), len(names))
+        for job in jobs:
+            self.assertEqual(job['status'], COMPLETED, job['error'])
+            self.assertEqual(job['attempts'], 1)
+            self.assertTrue(os.path.exists(job['filename']), job['filename'])
+        self.assertEqual(len({job['filename'] for job in jobs}), len(names))
+
+        logs = ''.join(self.read_log(name) for name in workers)
+        for job in jobs:
+            self.assertEqual(logs.count(f"job {job['id']} completed"), 1)
+
+    def test_lease_of_killed_worker_is_taken_over(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), SlowMediaHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        store = JobStore(self.db_path)
+        job_id, _ = store.enqueue(f'http://127.0.0.1:{server.server_port}/slow.mp4')
+
+        first = self.start_worker('first')
+        wait_for(lambda: store.jobs()[0]['status'] == RUNNING, 30,
+                 "the first worker did not claim the job")
+        time.sleep(1)  # Let the download start
+        first.send_signal(signal.SIGKILL)
+        first.wait()
+
+        self.start_worker('second').wait(timeout=120)
+
+        job = store.jobs()[0]
+        self.assertEqual(job['status'], COMPLETED, job['error'])
+        self.assertEqual(job['worker'], 'second')
+        self.assertEqual(job['attempts'], 2)
+        self.assertTrue(os.path.exists(job['filename']))
+        self.assertIn(f"job {job_id} completed", self.read_log('second'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,19 +7,25 @@ import sys
 import os
 import json
 import threading
+import multiprocessing
 import requests
 from io import BytesIO
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QLabel, QLineEdit, QPushButton, QComboBox, QRadioButton,
-    QButtonGroup, QProgressBar, QFileDialog, QMessageBox, QGroupBox
+    QButtonGroup, QProgressBar, QFileDialog, QMessageBox, QGroupBox, QSpinBox
 )
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer
 from PyQt5.QtGui import QPixmap, QFont, QIcon
 from PIL import Image
-import yt_dlp
 import pyperclip
 from plyer import notification
+from downloader_core import (
+    extract_video_info, extract_video_info_in_pool, get_extraction_pool,
+    shutdown_extraction_pool, select_format, format_size, CODEC_FAMILIES,
+    DownloadTask, check_ffmpeg
+)
+from download_daemon import start_local_daemon, QUEUED, DOWNLOADING, COMPLETED
 
 
 class VideoInfoFetcher(QThread):
@@ -27,68 +33,24 @@ class VideoInfoFetcher(QThread):
     info_fetched = pyqtSignal(dict)
     error_occurred = pyqtSignal(str)
 
-    def __init__(self, url):
+    def __init__(self, url, use_process_pool=False, client=None):
         super().__init__()
         self.url = url
+        self.use_process_pool = use_process_pool
+        self.client = client
 
     def run(self):
         try:
-            ydl_opts = {
-                'quiet': True,
-                'no_warnings': True,
-                'extract_flat': False,
-                'socket_timeout': 30,
-                'http_headers': {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                    'Accept-Language': 'en-US,en;q=0.9',
-                    'Accept-Encoding': 'gzip, deflate',
-                    'DNT': '1',
-                    'Connection': 'keep-alive',
-                    'Upgrade-Insecure-Requests': '1'
-                },
-                'cookiefile': None,  # Will be set in downloader
-                'noplaylist': True,
-            }
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(self.url, download=False)
-                
-                # Determine video type
-                video_type = "Regular Video"
-                if '/shorts/' in self.url:
-                    video_type = "YouTube Short"
-                elif '/clip/' in self.url or info.get('extractor') == 'youtube:clip':
-                    video_type = "YouTube Clip"
-                elif info.get('is_live'):
-                    video_type = "Live Stream (Active)"
-                elif info.get('was_live'):
-                    video_type = "Live Stream (Recorded)"
-                
-                formats = []
-                if info.get('formats'):
-                    for fmt in info['formats']:
-                        if fmt.get('height'):
-                            formats.append(fmt['height'])
-                    formats = sorted(list(set(formats)), reverse=True)
-                
-                duration_value = info.get('duration', 0)
-                try:
-                    duration_value = float(duration_value) if duration_value is not None else 0.0
-                except Exception:
-                    duration_value = 0.0
-
-                video_data = {
-                    'title': info.get('title', 'Unknown'),
-                    'thumbnail': info.get('thumbnail', ''),
-                    'duration': duration_value,
-                    'uploader': info.get('uploader', 'Unknown'),
-                    'video_type': video_type,
-                    'formats': formats,
-                    'url': self.url
-                }
-                
-                self.info_fetched.emit(video_data)
-                
+            if self.client:
+                video_data = self.client.info(self.url)
+            elif self.use_process_pool:
+                # Extraction runs in a worker process, this thread only waits
+                video_data = extract_video_info_in_pool(self.url)
+            else:
+                video_data = extract_video_info(self.url)
+
+            self.info_fetched.emit(video_data)
+
         except Exception as e:
             self.error_occurred.emit(str(e))
 
@@ -99,113 +61,66 @@ class VideoDownloader(QThread):
     download_complete = pyqtSignal(str)
     download_error = pyqtSignal(str)
 
-    def __init__(self, url, download_path, quality, download_type):
+    def __init__(self, url, download_path, quality, download_type,
+                 format_index=None, policy=None, write_buffer_kb=0,
+                 preallocate_files=True, client=None):
         super().__init__()
-        self.url = url
-        self.download_path = download_path
-        self.quality = quality
-        self.download_type = download_type
+        self.client = client
+        self.task = DownloadTask(
+            url, download_path, quality, download_type,
+            format_index=format_index,
+            policy=policy,
+            write_buffer_kb=write_buffer_kb,
+            preallocate_files=preallocate_files,
+            on_progress=self.progress_update.emit
+        )
 
-    def check_ffmpeg(self):
-        """Check if FFmpeg is available in the system"""
+    def run(self):
         try:
-            import subprocess
-            subprocess.run(['ffmpeg', '-version'], 
-                         capture_output=True, 
-                         check=True, 
-                         timeout=5)
-            return True
-        except:
-            return False
+            if self.client:
+                filename = self.run_in_daemon()
+            else:
+                filename = self.task.run()
+            self.download_complete.emit(filename)
+        except Exception as e:
+            self.download_error.emit(str(e))
 
-    def progress_hook(self, d):
-        if d['status'] == 'downloading':
-            try:
-                total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-                downloaded = d.get('downloaded_bytes', 0)
-                if total > 0:
-                    percent = (downloaded / total) * 100
-                    speed = d.get('speed', 0)
-                    speed_str = f"{speed / 1024 / 1024:.2f} MB/s" if speed else "calculating..."
-                    self.progress_update.emit(percent, speed_str)
-            except:
-                pass
-        elif d['status'] == 'finished':
-            self.progress_update.emit(100, "Processing...")
+    def run_in_daemon(self):
+        """Queue the download in the daemon and relay its progress"""
+        job = self.client.submit(
+            self.task.url,
+            download_path=self.task.download_path,
+            quality=self.task.quality,
+            type=self.task.download_type,
+            format_index=self.task.format_index,
+            policy=self.task.policy
+        )
+        for event in self.client.events(job['id']):
+            if event['status'] == DOWNLOADING:
+                self.progress_update.emit(event['percent'], event['speed'] or "calculating...")
+            elif event['status'] == COMPLETED:
+                return event['filename']
+            elif event['error']:
+                raise Exception(event['error'])
+            elif event['status'] != QUEUED:
+                raise Exception(f"Download {event['status']}")
+        raise Exception("Lost connection to the download daemon")
+
+
+class DaemonConnector(QThread):
+    """Thread that connects to (or starts) the download daemon"""
+    connected = pyqtSignal(object)  # DaemonClient, or None when unreachable
+
+    def __init__(self, daemon_url):
+        super().__init__()
+        self.daemon_url = daemon_url
 
     def run(self):
         try:
-            # Check if FFmpeg is available
-            ffmpeg_available = self.check_ffmpeg()
-            
-            # Base options with anti-blocking measures
-            base_opts = {
-                'quiet': False,
-                'no_warnings': False,
-                'socket_timeout': 30,
-                'http_headers': {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                    'Accept-Language': 'en-US,en;q=0.9',
-                    'Accept-Encoding': 'gzip, deflate',
-                    'DNT': '1',
-                    'Connection': 'keep-alive',
-                    'Upgrade-Insecure-Requests': '1'
-                },
-                'cookiefile': os.path.join(self.download_path, 'cookies.txt'),
-                'noplaylist': True,
-                'progress_hooks': [self.progress_hook],
-            }
-            
-            # Configure download options based on type
-            if self.download_type == 'audio':
-                if ffmpeg_available:
-                    # With FFmpeg: convert to MP3
-                    ydl_opts = {
-                        **base_opts,
-                        'format': 'bestaudio/best',
-                        'outtmpl': os.path.join(self.download_path, '%(title)s.%(ext)s'),
-                        'postprocessors': [{
-                            'key': 'FFmpegExtractAudio',
-                            'preferredcodec': 'mp3',
-                            'preferredquality': '192',
-                        }],
-                    }
-                else:
-                    # Without FFmpeg: download best audio format (usually m4a/webm)
-                    ydl_opts = {
-                        **base_opts,
-                        'format': 'bestaudio/best',
-                        'outtmpl': os.path.join(self.download_path, '%(title)s.%(ext)s'),
-                    }
-            else:  # video
-                if self.quality == 'best':
-                    format_str = 'bestvideo+bestaudio/best' if ffmpeg_available else 'best'
-                else:
-                    if ffmpeg_available:
-                        format_str = f'bestvideo[height<={self.quality}]+bestaudio/best[height<={self.quality}]'
-                    else:
-                        format_str = f'best[height<={self.quality}]'
-                
-                ydl_opts = {
-                    **base_opts,
-                    'format': format_str,
-                    'outtmpl': os.path.join(self.download_path, '%(title)s.%(ext)s'),
-                }
-                
-                # Only merge if FFmpeg is available
-                if ffmpeg_available:
-                    ydl_opts['merge_output_format'] = 'mp4'
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(self.url, download=True)
-                filename = ydl.prepare_filename(info)
-                if self.download_type == 'audio':
-                    # Change extension to mp3
-                    filename = os.path.splitext(filename)[0] + '.mp3'
-                self.download_complete.emit(filename)
-                
-        except Exception as e:
-            self.download_error.emit(str(e))
+            client = start_local_daemon(self.daemon_url)
+        except Exception:
+            client = None
+        self.connected.emit(client)
 
 
 class YouTubeDownloaderApp(QMainWindow):
@@ -216,30 +131,68 @@ class YouTubeDownloaderApp(QMainWindow):
         self.video_info = None
         self.download_path = os.path.join(os.path.expanduser("~"), "Downloads")
         self.last_clipboard = ""
+        self.process_pool_extraction = False
+        self.max_filesize_mb = 0  # 0 means no limit
+        self.max_bitrate_kbps = 0  # 0 means no limit
+        self.preferred_codec = ''
+        self.write_buffer_kb = 0  # 0 means yt-dlp default
+        self.preallocate_files = True
+        self.daemon_url = ''  # Empty means downloads run inside the app
+        self.daemon_client = None
         self.ffmpeg_available = self.check_ffmpeg_status()
         
         # Load configuration
         self.load_config()
+
+        # Start extraction workers early so the first check is not slowed down
+        if self.process_pool_extraction and not self.daemon_url:
+            get_extraction_pool()
         
         # Initialize UI
         self.init_ui()
         
+        # Hand downloads to the shared daemon, starting it if needed. This can
+        # take several seconds, so it happens in the background; until then
+        # checks and downloads run in this window
+        if self.daemon_url:
+            self.status_label.setText("Connecting to the download daemon...")
+            self.daemon_connector = DaemonConnector(self.daemon_url)
+            self.daemon_connector.connected.connect(self.on_daemon_connected)
+            self.daemon_connector.start()
+        
         # Start clipboard monitoring timer
         self.clipboard_timer = QTimer()
         self.clipboard_timer.timeout.connect(self.check_clipboard)
         self.clipboard_timer.start(1000)  # Check every second
 
+    def on_daemon_connected(self, client):
+        """Use the daemon once it answers, or explain why it is not used"""
+        self.daemon_client = client
+        # Do not overwrite the status of a check or download started meanwhile
+        connecting = self.status_label.text() == "Connecting to the download daemon..."
+        if client:
+            if connecting:
+                self.status_label.setText("Connected to the download daemon")
+            return
+        if connecting:
+            self.status_label.setText("Download daemon unavailable - downloading in this window")
+        if self.process_pool_extraction:
+            get_extraction_pool()
+        self.warn_daemon_unavailable()
+
+    def warn_daemon_unavailable(self):
+        """Explain why downloads run in the window despite daemon_url"""
+        QMessageBox.warning(
+            self, "Download Daemon",
+            f"Could not connect to the download daemon at {self.daemon_url}.\n"
+            "It may not be a local address, its port may be in use, or its token "
+            "may not match configurations/daemon_token.\n\n"
+            "Downloads will run inside this window instead."
+        )
+
     def check_ffmpeg_status(self):
         """Check if FFmpeg is installed"""
-        try:
-            import subprocess
-            subprocess.run(['ffmpeg', '-version'], 
-                         capture_output=True, 
-                         check=True, 
-                         timeout=5)
-            return True
-        except:
-            return False
+        return check_ffmpeg()
 
     def load_config(self):
         """Load configuration from JSON file"""
@@ -249,6 +202,14 @@ class YouTubeDownloaderApp(QMainWindow):
                 with open(config_path, 'r') as f:
                     config = json.load(f)
                     self.download_path = config.get('folder_path', self.download_path)
+                    self.process_pool_extraction = config.get(
+                        'process_pool_extraction', self.process_pool_extraction)
+                    self.max_filesize_mb = config.get('max_filesize_mb', self.max_filesize_mb)
+                    self.max_bitrate_kbps = config.get('max_bitrate_kbps', self.max_bitrate_kbps)
+                    self.preferred_codec = config.get('preferred_codec', self.preferred_codec)
+                    self.write_buffer_kb = config.get('write_buffer_kb', self.write_buffer_kb)
+                    self.preallocate_files = config.get('preallocate', self.preallocate_files)
+                    self.daemon_url = config.get('daemon_url', self.daemon_url)
             except:
                 pass
 
@@ -259,7 +220,14 @@ class YouTubeDownloaderApp(QMainWindow):
         config = {
             'folder_path': self.download_path,
             'quality': 'best',
-            'output': '{folder_path}/%(title)s.%(ext)s'
+            'output': '{folder_path}/%(title)s.%(ext)s',
+            'process_pool_extraction': self.process_pool_extraction,
+            'max_filesize_mb': self.max_filesize_mb,
+            'max_bitrate_kbps': self.max_bitrate_kbps,
+            'preferred_codec': self.preferred_codec,
+            'write_buffer_kb': self.write_buffer_kb,
+            'preallocate': self.preallocate_files,
+            'daemon_url': self.daemon_url
         }
         with open(config_path, 'w') as f:
             json.dump(config, f, indent=2)
@@ -401,6 +369,32 @@ class YouTubeDownloaderApp(QMainWindow):
         quality_layout.addStretch()
         options_layout.addLayout(quality_layout)
         
+        # Bandwidth limits
+        limit_layout = QHBoxLayout()
+        limit_label = QLabel("Max size:")
+        limit_layout.addWidget(limit_label)
+        
+        self.max_size_spin = QSpinBox()
+        self.max_size_spin.setRange(0, 100000)
+        self.max_size_spin.setSuffix(" MB")
+        self.max_size_spin.setSpecialValueText("No limit")
+        self.max_size_spin.setValue(self.max_filesize_mb)
+        self.max_size_spin.valueChanged.connect(self.on_policy_changed)
+        limit_layout.addWidget(self.max_size_spin)
+        
+        codec_label = QLabel("Codec:")
+        limit_layout.addWidget(codec_label)
+        
+        self.codec_combo = QComboBox()
+        self.codec_combo.addItem("Any", "")
+        for family in CODEC_FAMILIES:
+            self.codec_combo.addItem(family.upper(), family)
+        self.codec_combo.setCurrentIndex(max(0, self.codec_combo.findData(self.preferred_codec)))
+        self.codec_combo.currentIndexChanged.connect(self.on_policy_changed)
+        limit_layout.addWidget(self.codec_combo)
+        limit_layout.addStretch()
+        options_layout.addLayout(limit_layout)
+        
         # Download path
         path_layout = QHBoxLayout()
         path_label = QLabel("Save to:")
@@ -591,11 +585,17 @@ class YouTubeDownloaderApp(QMainWindow):
         self.status_label.setText("Fetching video information...")
         
         # Start fetching in background thread
-        self.fetcher_thread = VideoInfoFetcher(url)
+        self.fetcher_thread = VideoInfoFetcher(url, self.process_pool_extraction,
+                                               self.daemon_client)
         self.fetcher_thread.info_fetched.connect(self.on_info_fetched)
         self.fetcher_thread.error_occurred.connect(self.on_fetch_error)
         self.fetcher_thread.start()
 
+    def closeEvent(self, event):
+        """Stop background extraction workers when the window closes"""
+        shutdown_extraction_pool()
+        super().closeEvent(event)
+
     def on_info_fetched(self, video_data):
         """Handle successfully fetched video information"""
         self.video_info = video_data
@@ -626,16 +626,86 @@ class YouTubeDownloaderApp(QMainWindow):
         self.load_thumbnail(video_data['thumbnail'])
         
         # Update quality options
-        self.quality_combo.clear()
-        self.quality_combo.addItem("Best Quality", "best")
-        for resolution in video_data['formats']:
-            self.quality_combo.addItem(f"{resolution}p", str(resolution))
+        self.update_quality_options()
         
         # Enable download button
         self.download_button.setEnabled(True)
         self.check_button.setEnabled(True)
         self.status_label.setText("Video information loaded successfully!")
 
+    def get_format_policy(self):
+        """Build the format selection policy from the current settings"""
+        return {
+            'max_size': self.max_filesize_mb * 1024 * 1024 or None,
+            'max_tbr': self.max_bitrate_kbps or None,
+            'preferred_codec': self.preferred_codec,
+        }
+
+    def quality_label(self, name, quality):
+        """Label a quality option with its estimated download size"""
+        if not self.video_info or not self.video_info.get('format_index'):
+            return name
+        policy = self.get_format_policy()
+        selection = select_format(self.video_info['format_index'], quality,
+                                  'video', self.ffmpeg_available,
+                                  policy, allow_lower=False)
+        if not selection:
+            return f"{name} (over limit)" if self.is_over_limit(quality) else name
+        size = format_size(selection['filesize'])
+        if selection['filesize'] is not None and selection['size_estimated']:
+            size = f"~{size}"
+        return f"{name} - {size}"
+
+    def is_over_limit(self, quality):
+        """Check whether the size/bitrate limits are what rule out a height"""
+        if not self.video_info or not self.video_info.get('format_index'):
+            return False
+        policy = self.get_format_policy()
+        if not (policy['max_size'] or policy['max_tbr']):
+            return False
+        selection = select_format(self.video_info['format_index'], quality,
+                                  'video', self.ffmpeg_available,
+                                  policy, allow_lower=False)
+        return selection is None and self.is_downloadable(quality)
+
+    def is_downloadable(self, quality):
+        """Check that a height exists as a format we can save, ignoring limits.
+
+        Without FFmpeg only formats that already contain audio can be used,
+        so heights offered only as separate video streams are left out.
+        """
+        if not self.video_info or not self.video_info.get('format_index'):
+            return True
+        return select_format(self.video_info['format_index'], quality, 'video',
+                             self.ffmpeg_available, allow_lower=False) is not None
+
+    def update_quality_options(self):
+        """Fill the quality combo, keeping the current choice if possible"""
+        current = self.quality_combo.currentData()
+        self.quality_combo.clear()
+        self.quality_combo.addItem(self.quality_label("Best Quality", "best"), "best")
+        if self.video_info:
+            for resolution in self.video_info['formats']:
+                if not self.is_downloadable(str(resolution)):
+                    continue
+                self.quality_combo.addItem(
+                    self.quality_label(f"{resolution}p", str(resolution)), str(resolution))
+                if self.is_over_limit(str(resolution)):
+                    # Shown so the limit is visible, but the download would
+                    # silently fall back to a lower height, so it cannot be picked
+                    item = self.quality_combo.model().item(self.quality_combo.count() - 1)
+                    item.setEnabled(False)
+        index = self.quality_combo.findData(current)
+        if index >= 0 and self.quality_combo.model().item(index).isEnabled():
+            self.quality_combo.setCurrentIndex(index)
+
+    def on_policy_changed(self):
+        """Store new size/codec limits and refresh the size estimates"""
+        self.max_filesize_mb = self.max_size_spin.value()
+        self.preferred_codec = self.codec_combo.currentData()
+        self.save_config()
+        self.update_quality_options()
+
     def on_fetch_error(self, error_msg):
         """Handle error when fetching video information"""
         QMessageBox.critical(self, "Error", f"Failed to fetch video information:\n{error_msg}")
@@ -691,7 +761,12 @@ class YouTubeDownloaderApp(QMainWindow):
             self.video_info['url'],
             self.download_path,
             quality,
-            download_type
+            download_type,
+            self.video_info.get('format_index'),
+            self.get_format_policy(),
+            self.write_buffer_kb,
+            self.preallocate_files,
+            self.daemon_client
         )
         self.downloader_thread.progress_update.connect(self.on_progress_update)
         self.downloader_thread.download_complete.connect(self.on_download_complete)
@@ -742,6 +817,8 @@ class YouTubeDownloaderApp(QMainWindow):
 
 def main():
     """Main application entry point"""
+    # Needed for the extraction process pool in frozen Windows builds
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     app.setApplicationName("YouTube Video Downloader")
     